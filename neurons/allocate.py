@@ -1,6 +1,7 @@
 import os
 import json
 import torch
+import numpy as np
 import shutil
 import typing
 import sqlite3
@@ -114,6 +115,31 @@ def human_readable_size(size: int) -> str:
     return f"{size} bytes"
 
 
+def human_readable_sizes(sizes: np.ndarray) -> typing.List[str]:
+    """
+    Convert an array of sizes in bytes to human-readable format in one pass.
+
+    Args:
+        - sizes (np.ndarray): Sizes in bytes.
+
+    Returns:
+        - list: Human-readable sizes.
+    """
+    units = np.array(["bytes", "KB", "MB", "GB", "TB"])
+
+    # Each unit is a factor of 1 << 10 larger than the previous one.
+    magnitudes = np.clip(np.log2(np.maximum(sizes, 1)) // 10, 0, len(units) - 1)
+    magnitudes = magnitudes.astype(np.int64)
+    scaled = sizes / np.left_shift(1, 10 * magnitudes)
+
+    return [
+        f"{size} bytes" if magnitude == 0 else f"{value:.2f} {unit}"
+        for size, magnitude, value, unit in zip(
+            sizes.tolist(), magnitudes.tolist(), scaled.tolist(), units[magnitudes]
+        )
+    ]
+
+
 def run_rust_generate(alloc, restart=False):
     """
     This function runs a Rust script to generate the data and hashes databases.
@@ -21,24 +21,229 @@
 # Step 1: Import necessary libraries and modules
 import os
 import time
+import asyncio
+import aiohttp
 import torch
-import random
+import numpy as np
+import typing
 import argparse
 import traceback
 import bittensor as bt
 
 # Custom modules
-import copy
+import hmac
 import hashlib
 import sqlite3
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 # import this repo
 import storage
 import allocate
 
-MIN_N_CHUNKS = 1 << 10  # the minimum number of chunks a miner should provide at least is 1GB (CHUNK_SIZE * MIN_N_CHUNKS)
+# The minimum number of chunks a miner should provide at least is 1GB (CHUNK_SIZE * MIN_N_CHUNKS).
+MIN_N_CHUNKS = 1 << 10
+# The number of threads used to read validation hashes from the DBs concurrently.
+DB_WORKERS = 8
+# The page cache size of each hash DB connection in KiB.
+DB_CACHE_SIZE_KB = 20000
+# The number of bytes of each hash DB to memory-map (256MB).
+DB_MMAP_SIZE = 1 << 28
+# The maximum number of miners the validator sets weights for.
+MAX_WEIGHTS = 256
+# The maximum number of open connections from the dendrite to the miners.
+DENDRITE_MAX_CONNECTIONS = 256
+# The number of seconds an idle connection to a miner is kept alive.
+DENDRITE_KEEPALIVE_TIMEOUT = 60
+
+# Long-lived SQLite connections to the validator hash DBs, keyed by path.
+_conn_cache: typing.Dict[str, sqlite3.Connection] = {}
+
+
+def get_db_connection(path: str) -> sqlite3.Connection:
+    """
+    Return a cached connection to the hash DB under path, opening it on first use.
+    Reusing the connection lets sqlite3 keep the compiled SELECT in its statement
+    cache so subsequent lookups only rebind the chunk id. The page cache is grown
+    and the DB memory-mapped since lookups hit random single rows.
+
+    Args:
+        - path (str): The path to the hash database.
+
+    Returns:
+        - sqlite3.Connection: The connection to the database.
+    """
+    conn = _conn_cache.get(path)
+    if conn is None:
+        conn = sqlite3.connect(
+            path,
+            cached_statements=256,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        # Connection setup pragmas run once and are not kept in the statement cache.
+        conn.executescript(
+            f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}; PRAGMA mmap_size={DB_MMAP_SIZE};"
+        )
+        _conn_cache[path] = conn
+    return conn
+
+
+def fetch_validation_hash(alloc: dict, chunk_i: str) -> typing.Optional[bytes]:
+    """
+    Look up the stored hash of a chunk in the validator hash DB of an allocation.
+
+    Args:
+        - alloc (dict): The allocation whose hash DB to read.
+        - chunk_i (str): The id of the chunk.
+
+    Returns:
+        - bytes: The raw SHA-256 digest of the chunk, or None if it could not be read.
+    """
+    try:
+        validation_hash = (
+            get_db_connection(alloc["path"])
+            .execute(alloc["select_sql"], (chunk_i,))
+            .fetchone()[0]
+        )
+        bt.logging.debug(f"Validation hash: {validation_hash}")
+        # Keep the raw digest so verification compares bytes, not hex strings.
+        return bytes.fromhex(validation_hash)
+    except:
+        bt.logging.error(
+            f"Failed to get validation hash for chunk: {chunk_i} from db: {alloc['path']}"
+        )
+        return None
+
+
+def compute_hash(miner_data: typing.Optional[str]) -> typing.Optional[bytes]:
+    """
+    Compute the raw SHA-256 digest of the data returned by a miner.
+
+    Args:
+        - miner_data (str): The data returned by the miner, or None if it did not respond.
+
+    Returns:
+        - bytes: The digest of the data, or None if the miner did not respond.
+    """
+    if miner_data is None:
+        return None
+    return hashlib.sha256(miner_data.encode()).digest()
+
+
+async def validate_miner(
+    dendrite: bt.dendrite,
+    executor: ThreadPoolExecutor,
+    alloc: dict,
+    axon: bt.AxonInfo,
+    chunk_i: str,
+    timeout: float = 12,
+) -> typing.Tuple[typing.Optional[bytes], typing.Any]:
+    """
+    Read the validation hash of a chunk on the executor while the miner is queried
+    for the chunk itself, so disk and network work for the miner overlap.
+
+    Args:
+        - dendrite (bt.dendrite): The dendrite used to send the request.
+        - executor (ThreadPoolExecutor): The executor the DB read runs on.
+        - alloc (dict): The allocation of the miner.
+        - axon (bt.AxonInfo): The axon of the miner.
+        - chunk_i (str): The id of the chunk to validate.
+        - timeout (float): The timeout for the request in seconds. Default is 12.
+
+    Returns:
+        - tuple: The validation hash and the deserialized response of the miner.
+    """
+    loop = asyncio.get_running_loop()
+    validation_hash, miner_data = await asyncio.gather(
+        loop.run_in_executor(executor, fetch_validation_hash, alloc, chunk_i),
+        dendrite.forward(
+            axons=axon,
+            synapse=storage.protocol.Retrieve(key=chunk_i),
+            timeout=timeout,
+            deserialize=True,
+        ),
+    )
+    return validation_hash, miner_data
+
+
+def validate_miners(
+    dendrite: bt.dendrite,
+    executor: ThreadPoolExecutor,
+    allocations: typing.List[dict],
+    axons: typing.List[bt.AxonInfo],
+    chunk_keys: typing.List[str],
+) -> typing.List[typing.Tuple[typing.Optional[bytes], typing.Any]]:
+    """
+    Validate all the given miners concurrently and wait for all of them, so the step
+    takes as long as the slowest miner rather than the sum of all.
+
+    Args:
+        - dendrite (bt.dendrite): The dendrite used to send the requests.
+        - executor (ThreadPoolExecutor): The executor the DB reads run on.
+        - allocations (typing.List[dict]): The allocations of the miners.
+        - axons (typing.List[bt.AxonInfo]): The axons of the miners.
+        - chunk_keys (typing.List[str]): The id of the chunk to validate per miner.
+
+    Returns:
+        - list: The validation hash and response per miner, in the same order as axons.
+    """
+
+    async def _validate():
+        return await asyncio.gather(
+            *[
+                validate_miner(dendrite, executor, alloc, axon, chunk_i)
+                for alloc, axon, chunk_i in zip(allocations, axons, chunk_keys)
+            ]
+        )
+
+    return asyncio.get_event_loop().run_until_complete(_validate())
+
+
+def set_dendrite_session(dendrite: bt.dendrite):
+    """
+    Give the dendrite a keep-alive session sized for querying the whole metagraph at once,
+    so connections to each miner are reused across steps instead of being re-established.
+
+    Args:
+        - dendrite (bt.dendrite): The dendrite to set the session on.
+    """
+
+    async def _create_session():
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=DENDRITE_MAX_CONNECTIONS,
+                keepalive_timeout=DENDRITE_KEEPALIVE_TIMEOUT,
+                enable_cleanup_closed=True,
+            )
+        )
+
+    # The session must be bound to the event loop the queries run on.
+    dendrite._session = asyncio.get_event_loop().run_until_complete(_create_session())
+
+
+def close_dendrite_session(dendrite: bt.dendrite):
+    """
+    Close the session of the dendrite on the event loop it was created on, so aiohttp
+    does not warn about an unclosed session when the validator exits.
 
+    Args:
+        - dendrite (bt.dendrite): The dendrite whose session to close.
+    """
+    # This is the same private attribute set_dendrite_session assigns, so a bittensor
+    # upgrade that renames it breaks both helpers together.
+    if dendrite._session is not None:
+        asyncio.get_event_loop().run_until_complete(dendrite._session.close())
+        dendrite._session = None
+
+
+def close_db_connections():
+    """
+    Close all the cached hash DB connections opened by get_db_connection.
+    """
+    for conn in _conn_cache.values():
+        conn.close()
+    _conn_cache.clear()
 
 
 # Step 2: Set up the configuration parser
@@ -55,6 +260,13 @@ def get_config():
     )
     # Adds override arguments for network and netuid.
     parser.add_argument("--netuid", type=int, default=7, help="The chain subnet uid.")
+    # The number of steps between metagraph resyncs.
+    parser.add_argument(
+        "--steps_per_sync",
+        type=int,
+        default=100,
+        help="The number of steps between metagraph resyncs.",
+    )
     # Adds subtensor specific arguments i.e. --subtensor.chain_endpoint ... --subtensor.network ...
     bt.subtensor.add_args(parser)
     # Adds logging specific arguments i.e. --logging.debug ..., --logging.trace .. or --logging.logging_dir ...
@@ -76,8 +288,7 @@ def get_config():
         )
     )
     # Ensure the logging directory exists.
-    if not os.path.exists(config.full_path):
-        os.makedirs(config.full_path, exist_ok=True)
+    os.makedirs(config.full_path, exist_ok=True)
 
     # Return the parsed config.
     return config
@@ -106,6 +317,7 @@ def main(config):
 
     # Dendrite is the RPC client; it lets us send messages to other nodes (axons) in the network.
     dendrite = bt.dendrite(wallet=wallet)
+    set_dendrite_session(dendrite)
     bt.logging.info(f"Dendrite: {dendrite}")
 
     # The metagraph holds the state of the network, letting us know about other miners.
@@ -126,37 +338,41 @@ def main(config):
     # Step 6: Set up initial scoring weights for validation
     bt.logging.info("Building validation weights.")
     alpha = 0.9
-    scores = torch.ones_like(metagraph.S, dtype=torch.float32)
+    # Scores start at zero so that only verified miners can earn weight.
+    # The validator never validates itself, so its own uid stays at zero.
+    scores = torch.zeros_like(metagraph.S, dtype=torch.float32)
     bt.logging.info(f"Weights: {scores}")
 
     # Generate allocations for the validator.
+    # The validator hotkey and per-miner seeds and queries are fixed, so build them once here.
+    self_ss58 = wallet.hotkey.ss58_address
+    db_root_path = os.path.expanduser(config.db_root_path)
     next_allocations = []
-    verified_allocations = []
     for hotkey in tqdm(metagraph.hotkeys):
-        db_path = os.path.expanduser(
-            f"{config.db_root_path}/{config.wallet.name}/{config.wallet.hotkey}/DB-{hotkey}-{wallet.hotkey.ss58_address}"
-        )
+        db_path = f"{db_root_path}/{config.wallet.name}/{config.wallet.hotkey}/DB-{hotkey}-{self_ss58}"
+        seed = f"{hotkey}{self_ss58}"
         next_allocations.append(
             {
                 "path": db_path,
                 "n_chunks": MIN_N_CHUNKS,
-                "seed": f"{hotkey}{wallet.hotkey.ss58_address}",
-                "miner": hotkey,
-                "validator": wallet.hotkey.ss58_address,
-                "hash": True,
-            }
-        )
-        verified_allocations.append(
-            {
-                "path": db_path,
-                "n_chunks": 0,
-                "seed": f"{hotkey}{wallet.hotkey.ss58_address}",
+                "seed": seed,
                 "miner": hotkey,
-                "validator": wallet.hotkey.ss58_address,
+                "validator": self_ss58,
                 "hash": True,
+                "select_sql": f"SELECT hash FROM DB{seed} WHERE id=?",
             }
         )
 
+    # Track the estimated and verified number of chunks per miner as contiguous arrays.
+    # The allocation dicts are only updated from these when handed to allocate.generate.
+    n_chunks = np.full(len(next_allocations), MIN_N_CHUNKS, dtype=np.int64)
+    verified_n_chunks = np.zeros(len(next_allocations), dtype=np.int64)
+
+    # The uids of the miners to validate. Dont self validate.
+    valid_uids = [
+        i for i, alloc in enumerate(next_allocations) if alloc["miner"] != self_ss58
+    ]
+
     # Generate the hash allocations.
     allocate.generate(
         allocations=next_allocations,  # The allocations to generate.
@@ -167,130 +383,135 @@ def main(config):
 
     # Step 7: The Main Validation Loop
     bt.logging.info("Starting validator loop.")
+    rng = np.random.default_rng()
+    # Thread pools for the DB reads and response hashing, reused across steps.
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS)
+    hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
     step = 0
     while True:
         try:
-            # Iterate over all miners on the network and validate them.
-            previous_allocations = copy.deepcopy(next_allocations)
-            for i, alloc in tqdm(enumerate(next_allocations)):
-                # Dont self validate.
-                if alloc["miner"] == wallet.hotkey.ss58_address:
-                    continue
-                print(f"Validating miner: {alloc}")
-
-                # Select a random chunk to validate.
-                chunk_i = str(random.randint(1, alloc["n_chunks"]))
-                bt.logging.debug(f"Validating chunk: {chunk_i}")
-
-                # Get the hash of the data to validate from the database.
-                db = sqlite3.connect(alloc["path"])
-                try:
-                    validation_hash = (
-                        db.cursor()
-                        .execute(
-                            f"SELECT hash FROM DB{alloc['seed']} WHERE id=?", (chunk_i,)
-                        )
-                        .fetchone()[0]
-                    )
-                except:
-                    bt.logging.error(
-                        f"Failed to get validation hash for chunk: {chunk_i} from db: {alloc['path']}"
-                    )
-                    continue
-                bt.logging.debug(f"Validation hash: {validation_hash}")
-                db.close()
-
-                # Query the miner for the data.
-                miner_data = dendrite.query(
-                    metagraph.axons[i],
-                    storage.protocol.Retrieve(key=chunk_i),
-                    deserialize=True,
+            # Iterate over all miners on the network and select a chunk to validate.
+            previous_n_chunks = n_chunks.copy()
+            # Draw a random chunk to validate for every miner at once.
+            chunks = rng.integers(1, n_chunks + 1)
+            miner_idxs = valid_uids
+            chunk_keys = [str(chunk_i) for chunk_i in chunks[valid_uids].tolist()]
+            bt.logging.debug(f"Validating chunks: {dict(zip(miner_idxs, chunk_keys))}")
+
+            # Fetch the validation hashes and query the miners for their data concurrently.
+            results = validate_miners(
+                dendrite,
+                db_executor,
+                allocations=[next_allocations[i] for i in miner_idxs],
+                axons=[metagraph.axons[i] for i in miner_idxs],
+                chunk_keys=chunk_keys,
+            )
+
+            # Hash the miner responses in parallel, hashlib releases the GIL on large payloads.
+            computed_hashes = list(
+                hash_executor.map(
+                    compute_hash, [miner_data for _, miner_data in results]
                 )
+            )
+
+            # Score the miners on their responses.
+            # Rewards are collected per step and folded into the scores once after the loop.
+            rewards = torch.zeros_like(scores)
+            scored = torch.zeros_like(scores, dtype=torch.bool)
+            for i, (validation_hash, _), computed_hash in zip(
+                miner_idxs, results, computed_hashes
+            ):
+                # Skip the miners we could not get a validation hash for.
+                if validation_hash is None:
+                    continue
 
-                if miner_data == None:
+                scored[i] = True
+                if computed_hash == None:
                     # The miner could not respond with the data.
                     # We reduce the estimated allocation for the miner.
-                    next_allocations[i]["n_chunks"] = max(
-                        int(next_allocations[i]["n_chunks"] * 0.9), MIN_N_CHUNKS
-                    )
-                    verified_allocations[i]["n_chunks"] = min(
-                        next_allocations[i]["n_chunks"],
-                        verified_allocations[i]["n_chunks"],
-                    )
+                    n_chunks[i] = max(int(n_chunks[i] * 0.9), MIN_N_CHUNKS)
+                    verified_n_chunks[i] = min(n_chunks[i], verified_n_chunks[i])
                     bt.logging.debug(
-                        f"Miner did not respond with data, reducing allocation to: {next_allocations[i]['n_chunks']}"
+                        f"Miner did not respond with data, reducing allocation to: {n_chunks[i]}"
                     )
 
-                elif miner_data != None:
+                elif computed_hash != None:
                     # The miner was able to respond with the data, but we need to verify it.
-                    computed_hash = hashlib.sha256(miner_data.encode()).hexdigest()
-                    bt.logging.debug(
-                        f"   Computed hash: {computed_hash}, Validation hash: {validation_hash} "
-                    )
-
                     # Check if the miner has provided the correct response by doubling the dummy input.
-                    if computed_hash == validation_hash:
+                    if hmac.compare_digest(computed_hash, validation_hash):
                         # The miner has provided the correct response we can increase our known verified allocation.
                         # We can also increase our estimated allocation for the miner.
-                        verified_allocations[i]["n_chunks"] = next_allocations[i][
-                            "n_chunks"
-                        ]
-                        next_allocations[i]["n_chunks"] = int(
-                            next_allocations[i]["n_chunks"] * 1.1
-                        )
+                        rewards[i] = 1.0
+                        verified_n_chunks[i] = n_chunks[i]
+                        n_chunks[i] = int(n_chunks[i] * 1.1)
                         bt.logging.debug(
-                            f"Miner provided correct response, increasing allocation to: {next_allocations[i]['n_chunks']}"
+                            f"Miner provided correct response, increasing allocation to: {n_chunks[i]}"
                         )
                     else:
                         # The miner has provided an incorrect response.
                         # We need to decrease our estimation..
-                        next_allocations[i]["n_chunks"] = max(
-                            int(next_allocations[i]["n_chunks"] * 0.9), MIN_N_CHUNKS
-                        )
-                        verified_allocations[i]["n_chunks"] = min(
-                            next_allocations[i]["n_chunks"],
-                            verified_allocations[i]["n_chunks"],
+                        bt.logging.debug(
+                            f"   Computed hash: {computed_hash.hex()}, Validation hash: {validation_hash.hex()} "
                         )
+                        n_chunks[i] = max(int(n_chunks[i] * 0.9), MIN_N_CHUNKS)
+                        verified_n_chunks[i] = min(n_chunks[i], verified_n_chunks[i])
                         bt.logging.debug(
-                            f"Miner provided incorrect response, reducing allocation to: {next_allocations[i]['n_chunks']}"
+                            f"Miner provided incorrect response, reducing allocation to: {n_chunks[i]}"
                         )
 
-            # Reallocate the validator's chunks.
-            bt.logging.debug(
-                f"Prev allocations: {[ a['n_chunks'] for a in previous_allocations ]  }"
-            )
+            # Update the scores of the validated miners with an exponential moving average of their rewards.
+            scores[scored] = alpha * scores[scored] + (1 - alpha) * rewards[scored]
+            bt.logging.debug(f"Scores: {scores}")
+
+            # Reallocate the validator's chunks, only for the miners whose allocation changed.
+            bt.logging.debug(f"Prev allocations: {previous_n_chunks.tolist()}")
+            changed_allocations = []
+            for i in np.flatnonzero(n_chunks != previous_n_chunks).tolist():
+                next_allocations[i]["n_chunks"] = int(n_chunks[i])
+                changed_allocations.append(next_allocations[i])
             allocate.generate(
-                allocations=next_allocations,  # The allocations to generate.
+                allocations=changed_allocations,  # The allocations to generate.
                 no_prompt=True,  # If True, no prompt will be shown
                 restart=False,  # Dont restart the generation from empty files.
             )
             bt.logging.info(
-                f"Allocations: {[ allocate.human_readable_size( a['n_chunks'] * allocate.CHUNK_SIZE ) for a in next_allocations ] }"
+                f"Allocations: {allocate.human_readable_sizes( n_chunks * allocate.CHUNK_SIZE )}"
             )
 
             # Periodically update the weights on the Bittensor blockchain.
             if (step + 1) % 1000 == 0:
                 # TODO: Define how the validator normalizes scores before setting weights.
-                weights = torch.nn.functional.normalize(scores, p=1.0, dim=0)
-                bt.logging.info(f"Setting weights: {weights}")
-                # This is a crucial step that updates the incentive mechanism on the Bittensor blockchain.
-                # Miners with higher scores (or weights) receive a larger share of TAO rewards on this subnet.
-                result = subtensor.set_weights(
-                    netuid=config.netuid,  # Subnet to set weights on.
-                    wallet=wallet,  # Wallet to sign set weights using hotkey.
-                    uids=metagraph.uids,  # Uids of the miners to set weights for.
-                    weights=weights,  # Weights to set for the miners.
-                    wait_for_inclusion=True,
+                # Only the top scoring miners get a weight, which keeps the extrinsic small.
+                # Miners without a score, including the validator itself, are left out.
+                top_scores, top_uids = torch.topk(
+                    scores, k=min(len(scores), MAX_WEIGHTS)
                 )
-                if result:
-                    bt.logging.success("Successfully set weights.")
+                top_uids = top_uids[top_scores > 0]
+                top_scores = top_scores[top_scores > 0]
+                if len(top_uids) == 0:
+                    bt.logging.warning("No verified miners to set weights for.")
                 else:
-                    bt.logging.error("Failed to set weights.")
+                    weights = torch.nn.functional.normalize(top_scores, p=1.0, dim=0)
+                    bt.logging.info(f"Setting weights: {weights} for uids: {top_uids}")
+                    # This is a crucial step that updates the incentive mechanism on the Bittensor blockchain.
+                    # Miners with higher scores (or weights) receive a larger share of TAO rewards on this subnet.
+                    result = subtensor.set_weights(
+                        netuid=config.netuid,  # Subnet to set weights on.
+                        wallet=wallet,  # Wallet to sign set weights using hotkey.
+                        uids=top_uids,  # Uids of the miners to set weights for.
+                        weights=weights,  # Weights to set for the miners.
+                        wait_for_inclusion=True,
+                    )
+                    if result:
+                        bt.logging.success("Successfully set weights.")
+                    else:
+                        bt.logging.error("Failed to set weights.")
 
             # End the current step and prepare for the next iteration.
             step += 1
-            # Resync our local state with the latest state from the blockchain.
-            metagraph = subtensor.metagraph(config.netuid)
+            # Periodically resync our local state with the latest state from the blockchain.
+            if step % config.steps_per_sync == 0:
+                metagraph.sync(subtensor=subtensor, lite=True)
             # Wait a block step.
             time.sleep(1)
 
@@ -301,6 +522,10 @@ def main(config):
 
         # If the user interrupts the program, gracefully exit.
         except KeyboardInterrupt:
+            db_executor.shutdown()
+            hash_executor.shutdown()
+            close_db_connections()
+            close_dendrite_session(dendrite)
             bt.logging.success("Keyboard interrupt detected. Exiting validator.")
             exit()
 
@@ -310,4 +535,4 @@ if __name__ == "__main__":
     # Parse the configuration.
     config = get_config()
     # Run the main function.
-    main(config)
\ No newline at end of file
+    main(config)